@@ -1,15 +1,26 @@
 #!/usr/bin/python
 import argparse
+import codecs
 import csv
+import hashlib
+import json
 import re
 import string
 import sys, os, time
 
-from functools import partial
-from multiprocessing import Pool
+import multiprocessing
 
+import ahocorasick
 import errno
-import layout_scanner
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # Fall back to the (much slower) pdfminer based layout scanner
+    pdfium = None
+    import layout_scanner
+    from pdfminer.pdfparser import PDFSyntaxError
+    from pdfminer.pdftypes import PDFException
+    from pdfminer.psparser import PSException
 
 # Zotero CSV Column indices
 YEAR_I = 2
@@ -17,34 +28,139 @@ AUTHOR_I = 3
 TITLE_I = 4
 FILE_I = 37
 
+# Only the last pages of each PDF are searched, we assume references never take more TODO:HARDCODE
+LAST_PAGES = 10
+
 DEFAULT_OUTPUT_CSV_NAME = "titles.csv"
 DEFAULT_OUTPUT_DELIMITER = "\t"
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# pre_process() works on ASCII bytes: uppercase letters are lowercased, punctuation, digits and linebreaks are
+# dropped and any other byte is turned into whitespace
+_PRE_PROCESS_DELETE = (string.punctuation + string.digits + '\r\n').encode('ascii')
+_PRE_PROCESS_TABLE = bytes(c if chr(c) in string.ascii_lowercase
+                           else c + 32 if chr(c) in string.ascii_uppercase
+                           else ord(' ') for c in range(256))
+# With strip_whitespace, every byte that is not a letter is dropped in the same pass
+_PRE_PROCESS_DELETE_ALL = bytes(c for c in range(256) if chr(c) not in string.ascii_letters)
+
+
+def _pre_process_non_ascii(exc):
+    """Encoding error handler for pre_process(): non-ASCII digits are dropped like ASCII ones, any other
+    non-ASCII character becomes whitespace"""
+    return ''.join('' if c.isdecimal() else ' ' for c in exc.object[exc.start:exc.end]), exc.end
+
+
+codecs.register_error('pre_process', _pre_process_non_ascii)
+
+used_filenames = set()
 
-used_filenames = []
-graph = []
+# Aho-Corasick automaton over whitespace-stripped titles and the title ids its values index into.
+# Set in __main__ before the workers start, forked workers inherit them, otherwise init_worker() sets them
+title_automaton = None
+title_ids = None
+# Dir where extracted PDF text is cached between runs, None disables the cache
+pdf_cache_dir = None
 
 
 def pdf_to_text_list(file_loc):
     """
      Extracts text (string) of PDF file contents. Images, figures are ignored.
     :param str file_loc: Path to .PDF document on local disk
-    :return: The last 10 pages of the PDF document as string text, a list of strings
-    :rtype: list
+    :return: The page count and last LAST_PAGES pages of the PDF document as string text, a list of strings
+    :rtype: tuple
+    """
+    if pdfium is not None:
+        return pdfium_to_text_list(file_loc)
+
+    # Read PDF pages as text, only the last pages are laid out
+    try:
+        result = layout_scanner.get_last_pages(file_loc, LAST_PAGES)
+    except (PDFSyntaxError, PDFException, PSException):
+        result = None
+    if result is None:
+        print("[!] Issue parsing PDF file", file=sys.stderr)
+        return (-1, [])
+
+    return result
+
+
+def pdfium_to_text_list(file_loc):
+    """
+     Same as pdf_to_text_list(), but uses pypdfium2 and only extracts text of the pages that are needed
     """
-    # Read PDF pages as text
-    pages = layout_scanner.get_pages(file_loc, images_folder=None)  # you can try os.path.abspath("output/imgs")
     try:
-        page_len = len(pages)
-    except TypeError:
+        pdf = pdfium.PdfDocument(file_loc)
+    except (pdfium.PdfiumError, OSError):
         print("[!] Issue parsing PDF file", file=sys.stderr)
         return (-1, [])
 
-    # Take only last 10 pages (We assume references never take more) TODO:HARDCODE
-    pages = pages[-10:]
+    try:
+        page_len = len(pdf)
+        pages = []
+        for i in range(max(0, page_len - LAST_PAGES), page_len):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            pages.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+    except pdfium.PdfiumError:
+        print("[!] Issue parsing PDF page", file=sys.stderr)
+        return (-1, [])
+    finally:
+        pdf.close()
 
     return (page_len, pages)
 
 
+def get_pdf_cache_file(file_loc, cache_dir):
+    """
+    Finds the cache file for the extracted text of a PDF, keyed by the file path, modification time and size
+    :param str file_loc: Path to .PDF document on local disk
+    :param str cache_dir: Dir of the cache, None if caching is disabled
+    :return: path of the cache file (which may not exist yet), or None if the PDF can not be cached
+    :rtype: str
+    """
+    if not cache_dir:
+        return None
+    try:
+        stat = os.stat(file_loc)
+    except OSError:
+        return None
+
+    # The text also depends on the number of pages read and the PDF backend used
+    key = repr((os.path.abspath(file_loc), stat.st_mtime_ns, stat.st_size, LAST_PAGES, pdfium is not None))
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def cached_pdf_to_text_list(file_loc, cache_dir):
+    """
+     Same as pdf_to_text_list(), but the result is kept in cache_dir, so that re-runs skip parsing unchanged PDFs
+    """
+    cache_file = get_pdf_cache_file(file_loc, cache_dir)
+    if cache_file is None:
+        return pdf_to_text_list(file_loc)
+
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as infile:
+            page_len, pages = json.load(infile)
+        return (page_len, pages)
+    except (OSError, ValueError, TypeError):
+        pass
+
+    result = pdf_to_text_list(file_loc)
+    if result[0] != -1:
+        # Write to a temporary file first, so that an interrupted run never leaves a truncated cache entry
+        tmp_file = "%s.%s.tmp" % (cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as outfile:
+                json.dump(result, outfile)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            print("[!] Could not write PDF text cache file", cache_file, file=sys.stderr)
+    return result
+
+
 def get_pretty_filename(metadata):
     fixed_title = re.sub('[^A-Za-z0-9]+', '', "_".join(metadata["title"].split(" ")[:10]))
     authors = metadata["author"].split(";")
@@ -57,7 +173,7 @@ def get_pretty_filename(metadata):
     txt_filename = "%s %s %s" % (author_1st, author_2nd, metadata["year"])
     if txt_filename in used_filenames:
         txt_filename = txt_filename + fixed_title[:-20]
-    used_filenames.append(txt_filename)
+    used_filenames.add(txt_filename)
     return txt_filename
 
 def create_missing_dirs(filename):
@@ -75,14 +191,51 @@ def read_titles(zotero_csv):
         reader = csv.reader(csvfile, delimiter=',')
         next(csvfile)  # Skip header
         for r in reader:
-            titles[pre_process(r[TITLE_I])] = \
+            title_pp = pre_process(r[TITLE_I])
+            # 'title_pp' is the paper's id, workers get it with the metadata for the self-citation check
+            titles[title_pp] = \
                 {'title': r[TITLE_I],
+                 'title_pp': title_pp,
+                 'title_pp_nospace': title_pp.replace(' ', ''),
                  'author': r[AUTHOR_I],
                  'file': r[FILE_I],
                  'year': r[YEAR_I]}
     return titles
 
 
+def find_first_pdf(metadata):
+    """
+    Finds the first PDF file among the CSV lines' file attachments
+    :return: path to the PDF file, or None if no PDF is attached
+    :rtype: str
+    """
+    for file in metadata['file'].split(';'):
+        if file.lower().strip().endswith(".pdf"):
+            return file
+    return None
+
+
+def prefetch_pdf(file_loc):
+    """
+    Asks the OS to start reading the PDF file into the page cache in the background, so that the disk reads
+    of many files overlap instead of each worker waiting on its own file. Does nothing where posix_fadvise
+    is not available
+    :param str file_loc: Path to .PDF document on local disk
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(file_loc, os.O_RDONLY)
+    except OSError:
+        return  # Reported by the worker when it fails to read the file
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
 def process_pdf(metadata, write_to_disk=False):
     """
     Reads text from PDF file specified in the CSV lines' file column, optionally saves it to .txt on disk
@@ -99,20 +252,14 @@ def process_pdf(metadata, write_to_disk=False):
     if len(metadata['file']) < 1:
         return False, 'Missing Zotero file attachment', log
 
-    all_files = metadata['file'].split(';')
-    first_pdf = None
-    for file in all_files:
-        if file.lower().strip().endswith(".pdf"):
-            first_pdf = file
-            break
-
+    first_pdf = find_first_pdf(metadata)
     if first_pdf == None:
         return False, 'No PDF File attached to article entry', log
     else:
-        log.append("\t-- Found %s attachments, using pdf: %s" % (len(all_files), first_pdf))
+        log.append("\t-- Found %s attachments, using pdf: %s" % (len(metadata['file'].split(';')), first_pdf))
 
 
-    original_page_count, pages = pdf_to_text_list(first_pdf)
+    original_page_count, pages = cached_pdf_to_text_list(first_pdf, pdf_cache_dir)
     if original_page_count != -1:
         log.append("\t-- Checking last %s PDF pages out of %s total" % (len(pages), original_page_count))
 
@@ -130,24 +277,60 @@ def process_pdf(metadata, write_to_disk=False):
     return len(all_pages) > 0, all_pages, log
 
 
-def find_citations(paper_text, all_titles, metadata):
+def build_title_automaton(all_titles):
+    """
+    Builds an Aho-Corasick automaton matching the whitespace-stripped titles, so that a paper's text
+    can be checked against all titles in a single pass
+    :param list all_titles: stripped titles, the value stored for each word is a tuple of the indices in this list
+        having that stripped title (titles differing only in whitespace share one) and its length
+    :return: the finalized automaton
+    :rtype: ahocorasick.Automaton
+    """
+    indices = {}
+    for i, stripped in enumerate(all_titles):
+        indices.setdefault(stripped, []).append(i)
+    automaton = ahocorasick.Automaton()
+    for stripped, title_indices in indices.items():
+        automaton.add_word(stripped, (title_indices, len(stripped)))
+    automaton.make_automaton()
+    return automaton
+
+
+def init_worker(automaton, all_titles, cache_dir):
+    global title_automaton, title_ids, pdf_cache_dir
+    title_automaton = automaton
+    title_ids = all_titles
+    pdf_cache_dir = cache_dir
+
+
+def find_citations(paper_text, all_titles, metadata, automaton):
     log = []
     cited_ids = []
     # Check which titles this paper cited:
-    fixed_paper_title = pre_process(metadata["title"])
-    fixed_text = pre_process(paper_text)
-
-    # remove whitespace
-    for title in all_titles:
-        if (title != fixed_paper_title) and \
-                (title.replace(' ', '') in fixed_text.replace(' ', '')):  # Stripping whitespace!
-            log.append("\t---- citation found:" + title)
-            cited_ids.append(title)
-            # graph.append([fixed_paper_title, title])
+    own_id = metadata["title_pp"]
+    needle_text = pre_process(paper_text, strip_whitespace=True)  # Stripping whitespace!
+
+    # A title found inside a longer title's occurrence (e.g. "Climate change" within "Climate change adaptation
+    # in coastal cities") is part of that reference, not a citation of its own. Going through the matches by
+    # start position, longest first, a match is covered if an earlier one already reaches as far
+    matches = sorted((end - length, -length, end, indices)
+                     for end, (indices, length) in automaton.iter(needle_text))
+    covered_until = -1
+    seen = set()
+    for _, _, end, indices in matches:
+        if end <= covered_until:
+            continue
+        covered_until = end
+        for i in indices:
+            if all_titles[i] != own_id and i not in seen:
+                seen.add(i)
+                title = all_titles[i]
+                log.append("\t---- citation found:" + title)
+                cited_ids.append(title)
     return cited_ids, log
 
 
-def article_worker(dict_item, all_titles):
+def article_worker(dict_item):
     t0 = time.time()
 
     print_log = []
@@ -166,30 +349,30 @@ def article_worker(dict_item, all_titles):
 
     cited_papers = []
     if pdf_result:
-        cited_papers, citations_log = find_citations(text, all_titles, metadata)
+        cited_papers, citations_log = find_citations(text, title_ids, metadata, title_automaton)
         print_log += citations_log
         t2 = time.time()
         print_log.append("\t-- processed text cites in % seconds" % (t2 - t1))
 
     print("\n".join(print_log) + "\n\n")
 
-    return title, pdf_result, text, cited_papers
-
-
-def pre_process(text):
-    # to lowercase
-    text = text.lower()
-    # remove punctuation
-    text = text.translate(str.maketrans('', '', string.punctuation))
-    # remove linebreaks
-    # text = re.sub(r"(?<=[a-z])\r?\n", " ", text)
-    text = text.replace('\r', '').replace('\n', '')
-    # remove numbers
-    text = re.sub(r'\d+', '', text)
+    # Only the error message is sent back to the main process, the parsed text is not needed there
+    return title, pdf_result, (None if pdf_result else text), cited_papers
+
+
+def pre_process(text, strip_whitespace=False):
+    # Some non-ASCII characters lowercase to ASCII letters (e.g. the Kelvin sign to 'k'), other non-ASCII
+    # characters become word separators
+    if not text.isascii():
+        text = text.lower()
+    buf = text.encode('ascii', 'pre_process')
+    if strip_whitespace:
+        # Same as pre_process(text).replace(' ', ''), without building the spaced text first
+        return buf.translate(_PRE_PROCESS_TABLE, _PRE_PROCESS_DELETE_ALL).decode('ascii')
+    # to lowercase, remove punctuation, linebreaks and numbers, everything else becomes whitespace
+    buf = buf.translate(_PRE_PROCESS_TABLE, _PRE_PROCESS_DELETE)
     # remove whitespace
-    text = " ".join(re.findall(r'[a-z]+', text))
-
-    return text
+    return b" ".join(buf.split()).decode('ascii')
 
 def make_directory_if_missing(directory_path):
     if not os.path.exists(os.path.dirname(directory_path)):
@@ -208,8 +391,12 @@ if __name__ == '__main__':
                         help='Output dir for gephi Edges and Nodes files (default: "gephi")')
     parser.add_argument('--processes', default=4, type=int,
                         help='How many worker processes to create for the time-consuming PDF parsing (default: 4)')
+    parser.add_argument('--chunksize', default=1, type=int,
+                        help='How many papers are sent to a worker process at a time (default: 1)')
     parser.add_argument('--txts_dir', default="papers", type=str,
                         help='Output dir for article txt files (default: "papers")')
+    parser.add_argument('--cache_dir', default="cache", type=str,
+                        help='Dir for caching extracted PDF text between runs, "" disables caching (default: "cache")')
     parser.add_argument('--out_csv', default=DEFAULT_OUTPUT_CSV_NAME, type=str,
                         help='Output csv filename (default: ' + DEFAULT_OUTPUT_CSV_NAME + ')')
     parser.add_argument('--delimiter', default=DEFAULT_OUTPUT_DELIMITER, type=str,
@@ -219,34 +406,74 @@ if __name__ == '__main__':
     OUTPUT_CSV_NAME = args.out_csv
     OUTPUT_GEPHI_DIR = args.gephi_dir
     OUTPUT_DELIMITER = args.delimiter
+    if len(OUTPUT_DELIMITER) != 1:
+        parser.error("--delimiter must be a single character")
     WORKER_PROCESSES = args.processes
+    WORKER_CHUNKSIZE = args.chunksize
+    pdf_cache_dir = args.cache_dir or None
 
     out_edges_filedir = OUTPUT_GEPHI_DIR + os.sep + "Edges_" + OUTPUT_CSV_NAME
     out_nodes_filedir = OUTPUT_GEPHI_DIR + os.sep + "Nodes_" + OUTPUT_CSV_NAME
 
     make_directory_if_missing(out_edges_filedir)
     make_directory_if_missing(out_nodes_filedir)
+    if pdf_cache_dir:
+        make_directory_if_missing(pdf_cache_dir + os.sep)
 
     error_documents = []
 
     # First, just get the titles in the csv
     titles_dict = read_titles(args.zotero_csv)
     title_ids = list(titles_dict.keys())
+    # read_titles() already stripped the whitespace from each title once
+    stripped_titles = [titles_dict[t]["title_pp_nospace"] for t in title_ids]
 
     # Now process the PDFs
     pool_start_time = time.time()
 
-    pool = Pool(processes=WORKER_PROCESSES)  # start n worker processes
-
-    list_worker = partial(article_worker, all_titles=title_ids)
-    result = pool.map(list_worker, list(titles_dict.items()), chunksize=5)
-    for title, pdf_result, text, cited_papers in result:
-        if pdf_result:
-            for paper in cited_papers:
-                graph.append([title, paper])
+    title_automaton = build_title_automaton(stripped_titles)
+    # start n worker processes, forked workers share the titles and automaton without pickling them. Fork is only
+    # used on Linux, elsewhere (e.g. macOS) forking after loading native libraries like PDFium is unsafe.
+    # Threads are no alternative: PDFium is not thread-safe and the pdfminer fallback holds the GIL
+    if sys.platform.startswith('linux'):
+        pool = multiprocessing.get_context('fork').Pool(processes=WORKER_PROCESSES)
+    else:
+        pool = multiprocessing.Pool(processes=WORKER_PROCESSES, initializer=init_worker,
+                                    initargs=(title_automaton, title_ids, pdf_cache_dir))
 
-        else:
-            error_documents.append([title, text])
+    # Write Graph Edges to csv as the papers get processed, instead of keeping all of them in memory
+    with open(out_edges_filedir, "a", buffering=OUTPUT_BUFFER_SIZE, newline='') as graph_csv:
+        graph_writer = csv.writer(graph_csv, delimiter=OUTPUT_DELIMITER, lineterminator="\n")
+        # Header
+        graph_writer.writerow(["Source", "Target", "Weight"])
+
+        # PDF parsing times vary a lot, so hand out papers in small chunks and collect them as they finish
+        results = pool.imap_unordered(article_worker, titles_dict.items(), chunksize=WORKER_CHUNKSIZE)
+
+        # Prefetch only a window of the PDFs the workers get to next, advanced as results arrive, so that
+        # files are not pushed out of the page cache before a worker reads them. PDFs whose text is already
+        # cached are never read, so they are left out
+        pdf_files = []
+        for metadata in titles_dict.values():
+            first_pdf = find_first_pdf(metadata)
+            if first_pdf is not None:
+                cache_file = get_pdf_cache_file(first_pdf, pdf_cache_dir)
+                if cache_file is None or not os.path.exists(cache_file):
+                    pdf_files.append(first_pdf)
+        next_prefetch = min(len(pdf_files), 2 * WORKER_PROCESSES)
+        for pdf_file in pdf_files[:next_prefetch]:
+            prefetch_pdf(pdf_file)
+
+        for title, pdf_result, error_msg, cited_papers in results:
+            if next_prefetch < len(pdf_files):
+                prefetch_pdf(pdf_files[next_prefetch])
+                next_prefetch += 1
+            if pdf_result:
+                graph_writer.writerows([title, paper, "1"] for paper in cited_papers)
+            else:
+                error_documents.append([title, error_msg])
+    pool.close()
+    pool.join()
     total_time = time.time() - pool_start_time
 
     # Print finish report, show failed documents
@@ -258,18 +485,10 @@ if __name__ == '__main__':
         print( "%s. %s %s %s %s" % (i, doc["author"], doc["year"], doc["title"], doc["file"]))
         print("\t--", reason)
 
-    # Write Graph Edges to csv
-    with open(OUTPUT_GEPHI_DIR + os.sep + "Edges_" + OUTPUT_CSV_NAME, "a") as graph_csv:
-        # Header
-        graph_csv.write(OUTPUT_DELIMITER.join(["Source", "Target", "Weight"]) + "\n")
-        for (src, target) in graph:
-            graph_csv.write(OUTPUT_DELIMITER.join([src, target, "1"]) + "\n")
-
     # Write Graph Nodes with Labels to csv
-    with open(OUTPUT_GEPHI_DIR + os.sep + "Nodes_" + OUTPUT_CSV_NAME, "a") as nodes_csv:
+    with open(out_nodes_filedir, "a", buffering=OUTPUT_BUFFER_SIZE, newline='') as nodes_csv:
+        nodes_writer = csv.writer(nodes_csv, delimiter=OUTPUT_DELIMITER, lineterminator="\n")
         # Header
-        nodes_csv.write(OUTPUT_DELIMITER.join(["Id", "Label", "Author", "PrettyName"]) + "\n")
-        for title in title_ids:
-            metadata = titles_dict[title]
-            nodes_csv.write(OUTPUT_DELIMITER.join(
-                [title, metadata["title"], metadata["author"], get_pretty_filename(metadata)]) + "\n")
+        nodes_writer.writerow(["Id", "Label", "Author", "PrettyName"])
+        nodes_writer.writerows([title, metadata["title"], metadata["author"], get_pretty_filename(metadata)]
+                               for title, metadata in titles_dict.items())
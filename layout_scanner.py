@@ -190,9 +190,8 @@ def parse_lt_objs (lt_objs, page_number, images_folder, text_content=None):
 ### Processing Pages
 ###
 
-def _parse_pages (doc, images_folder):
-    """With an open PDFDocument object, get the pages and parse each one
-    [this is a higher-order function to be passed to with_pdf()]"""
+def _parse_page_list (pages, images_folder, first_page_number=1):
+    """Parse each of the given PDFPage objects, returning a list of strings with the text found in each"""
     rsrcmgr = PDFResourceManager()
     laparams = LAParams()
     # device = PDFPageAggregator(rsrcmgr, laparams=laparams)
@@ -200,15 +199,33 @@ def _parse_pages (doc, images_folder):
     interpreter = PDFPageInterpreter(rsrcmgr, device)
 
     text_content = []
-    for i, page in enumerate(PDFPage.create_pages(doc)):
+    for i, page in enumerate(pages, first_page_number):
         interpreter.process_page(page)
         # receive the LTPage object for this page
         layout = device.get_result()
         # layout is an LTPage object which may contain child objects like LTTextBox, LTFigure, LTImage, etc.
-        text_content.append(parse_lt_objs(layout, (i+1), images_folder))
+        text_content.append(parse_lt_objs(layout, i, images_folder))
 
     return text_content
 
-def get_pages (pdf_doc, pdf_pwd='', images_folder='/tmp'):
+def _parse_pages (doc, images_folder):
+    """With an open PDFDocument object, get the pages and parse each one
+    [this is a higher-order function to be passed to with_pdf()]"""
+    return _parse_page_list(PDFPage.create_pages(doc), images_folder)
+
+def _parse_last_pages (doc, page_count, images_folder):
+    """With an open PDFDocument object, get the pages and parse only the last page_count ones
+    [this is a higher-order function to be passed to with_pdf()]"""
+    # Reading the page tree is cheap compared to interpreting and laying out the page contents
+    pages = list(PDFPage.create_pages(doc))
+    first = max(0, len(pages) - page_count)
+    return len(pages), _parse_page_list(pages[first:], images_folder, first + 1)
+
+def get_pages (pdf_doc, pdf_pwd='', images_folder=None):
     """Process each of the pages in this pdf file and return a list of strings representing the text found in each page"""
     return with_pdf(pdf_doc, _parse_pages, pdf_pwd, *tuple([images_folder]))
+
+def get_last_pages (pdf_doc, page_count, pdf_pwd='', images_folder=None):
+    """Process only the last page_count pages in this pdf file and return a tuple of the total number of pages
+    and a list of strings representing the text found in each processed page"""
+    return with_pdf(pdf_doc, _parse_last_pages, pdf_pwd, page_count, images_folder)